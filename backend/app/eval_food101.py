@@ -6,30 +6,162 @@ Usage example:
     python eval_food101.py \
         --models "qwen3-vl:8b,llava-v1.6-vl:13b,acpm-vl:7b" \
         --num_samples 100
+
+Samples are streamed and JPEG-encoded by a background thread while earlier
+(sample, model) requests are in flight. For Ollama to actually serve them in
+parallel, start the server with e.g. `OLLAMA_NUM_PARALLEL=8 ollama serve`.
 """
 
 import argparse
+import asyncio
+import os
+import queue
 import re
+import threading
 import time
-from typing import Dict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
 
 from datasets import load_dataset
 from PIL import Image
 
 # Adjust this import to match your project layout
 # (this assumes you're running from the repo root)
-from vlm import classify
+from vlm import classify_async, aclose_openai_async, _image_to_b64_fast
+
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9 ]+")
+_SPACES_RE = re.compile(r"\s+")
 
 
 def normalize_label(s: str) -> str:
     """Lowercase, remove punctuation, collapse spaces."""
-    s = (s or "").lower()
+    return _normalize_label_cached(str(s or ""))
+
+
+@lru_cache(maxsize=4096)
+def _normalize_label_cached(s: str) -> str:
+    s = s.lower()
     s = s.replace("_", " ")
-    s = re.sub(r"[^a-z0-9 ]+", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _NON_ALNUM_RE.sub(" ", s)
+    s = _SPACES_RE.sub(" ", s).strip()
     return s
 
 
+async def _timed_classify(sem: asyncio.Semaphore, img: Image.Image, b64: Optional[str], backend: str, model: str):
+    async with sem:
+        t0 = time.time()
+        res = await classify_async(img, backend=backend, model=model, image_b64=b64)
+        return res, time.time() - t0
+
+
+_DONE = object()
+
+
+def _prefetch(ds, label_names: List[str], q: queue.Queue):
+    """Producer thread: decode + encode samples ahead of the inference loop."""
+    try:
+        for sample in ds:
+            img: Image.Image = sample["image"]  # already a PIL Image
+            gt_name_raw: str = label_names[sample["label"]]  # e.g. 'spaghetti_bolognese'
+            # Encode each image once and share it across all models
+            try:
+                b64 = _image_to_b64_fast(img)
+            except Exception:
+                # Leave it to classify_async, which re-raises per model so the
+                # sample is counted as an ERROR rather than ending the stream
+                b64 = None
+            q.put((img, gt_name_raw, b64))
+    except Exception as e:
+        print(f"Dataset stream stopped early: {e}")
+    finally:
+        q.put(_DONE)
+
+
+def _report_sample(idx: int, total: int, gt_name_raw: str, results, models: List[str], stats):
+    """Print and tally one sample's results (one entry per model, in `models` order)."""
+    gt_name_norm: str = normalize_label(gt_name_raw) # e.g. 'spaghetti bolognese'
+
+    print(f"\n=== Sample {idx+1}/{total} | GT: {gt_name_raw} ===")
+
+    for model_name, res in zip(models, results):
+        s = stats[model_name]
+        s["total"] += 1
+
+        if isinstance(res, BaseException):
+            # Count as a failure (incorrect, no latency)
+            print(f"[{model_name}] ERROR: {res}")
+            continue
+
+        (pred_label, portion_g, conf, trace), dt = res
+
+        pred_norm = normalize_label(str(pred_label))
+        correct = int(
+            pred_norm == gt_name_norm
+            or gt_name_norm in pred_norm
+            or pred_norm in gt_name_norm
+        )
+
+        s["correct"] += correct
+        s["lat_sum"] += dt
+        s["lat_count"] += 1
+
+        print(
+            f"[{model_name}] "
+            f"pred='{pred_label}' (norm='{pred_norm}') | "
+            f"gt='{gt_name_norm}' | "
+            f"correct={bool(correct)} | "
+            f"latency={dt:.3f}s"
+        )
+
+
+async def _run_all(q: queue.Queue, models: List[str], backend: str, concurrency: int, on_sample: Callable):
+    """
+    Consume prefetched samples and run every model on each, bounded by `concurrency`.
+    Requests for different samples overlap, but `on_sample(idx, gt_name_raw, results)`
+    is called in sample order as soon as each sample (and all before it) finishes.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency))
+    # Cap samples in flight so the bounded queue back-pressures the producer
+    slots = asyncio.Semaphore(max(1, -(-concurrency // len(models))))
+
+    async def run_sample(img: Image.Image, b64: Optional[str]):
+        try:
+            return await asyncio.gather(
+                *[_timed_classify(sem, img, b64, backend, m) for m in models],
+                return_exceptions=True,
+            )
+        finally:
+            slots.release()
+
+    done_q: asyncio.Queue = asyncio.Queue()
+
+    async def consume():
+        try:
+            while True:
+                await slots.acquire()
+                item = await asyncio.to_thread(q.get)
+                if item is _DONE:
+                    slots.release()
+                    break
+                img, gt_name_raw, b64 = item
+                await done_q.put((gt_name_raw, asyncio.create_task(run_sample(img, b64))))
+        finally:
+            await done_q.put(None)
+
+    async def report():
+        idx = 0
+        while (entry := await done_q.get()) is not None:
+            gt_name_raw, task = entry
+            on_sample(idx, gt_name_raw, await task)
+            idx += 1
+
+    try:
+        await asyncio.gather(consume(), report())
+    finally:
+        await aclose_openai_async()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -51,6 +183,12 @@ def main():
         default=50,
         help="Number of Food-101 test images to evaluate (default: 50)",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("OLLAMA_NUM_PARALLEL", "8")),
+        help="Max in-flight VLM requests (default: $OLLAMA_NUM_PARALLEL or 8)",
+    )
     args = parser.parse_args()
 
    
@@ -66,10 +204,15 @@ def main():
         raise SystemExit("No models provided via --models")
 
     print(f"Using backend={args.backend}, models={models}")
+    if args.backend == "ollama":
+        print(
+            f"OLLAMA_NUM_PARALLEL={os.getenv('OLLAMA_NUM_PARALLEL', 'unset')} "
+            f"(server-side), concurrency={args.concurrency}"
+        )
     print(f"Loading Food-101 test split (first {args.num_samples} samples)...")
 
-    # Load first N images from the Food-101 test split
-    ds = load_dataset("food101", split=f"validation[:{args.num_samples}]")
+    # Stream the first N images from the Food-101 test split
+    ds = load_dataset("food101", split="validation", streaming=True).take(args.num_samples)
 
     label_names = ds.features["label"].names  # integer -> class name (e.g. 'spaghetti_bolognese')
 
@@ -83,50 +226,19 @@ def main():
             "lat_count": 0,
         }
 
-    # Main evaluation loop
-    for idx, sample in enumerate(ds):
-        img: Image.Image = sample["image"]  # already a PIL Image
-        gt_idx: int = sample["label"]
-        gt_name_raw: str = label_names[gt_idx]           # e.g. 'spaghetti_bolognese'
-        gt_name_norm: str = normalize_label(gt_name_raw) # e.g. 'spaghetti bolognese'
+    # Background thread keeps a few decoded + encoded samples ready
+    q: queue.Queue = queue.Queue(maxsize=4)
+    threading.Thread(target=_prefetch, args=(ds, label_names, q), daemon=True).start()
 
-        print(f"\n=== Sample {idx+1}/{len(ds)} | GT: {gt_name_raw} ===")
+    def on_sample(idx: int, gt_name_raw: str, results):
+        _report_sample(idx, args.num_samples, gt_name_raw, results, models, stats)
 
-        for model_name in models:
-            s = stats[model_name]
-            s["total"] += 1
-
-            try:
-                t0 = time.time()
-                pred_label, portion_g, conf, trace = classify(
-                    img,
-                    backend=args.backend,
-                    model=model_name,
-                )
-                dt = time.time() - t0
-
-                pred_norm = normalize_label(str(pred_label))
-                correct = int(
-                    pred_norm == gt_name_norm
-                    or gt_name_norm in pred_norm
-                    or pred_norm in gt_name_norm
-                )
-
-                s["correct"] += correct
-                s["lat_sum"] += dt
-                s["lat_count"] += 1
-
-                print(
-                    f"[{model_name}] "
-                    f"pred='{pred_label}' (norm='{pred_norm}') | "
-                    f"gt='{gt_name_norm}' | "
-                    f"correct={bool(correct)} | "
-                    f"latency={dt:.3f}s"
-                )
-
-            except Exception as e:
-                # Count as a failure (incorrect, no latency)
-                print(f"[{model_name}] ERROR: {e}")
+    # Main evaluation: requests overlap each other and dataset loading;
+    # each sample is printed and counted as soon as it completes
+    try:
+        asyncio.run(_run_all(q, models, args.backend, args.concurrency, on_sample))
+    except KeyboardInterrupt:
+        print("\nInterrupted; summarizing completed samples.")
 
     # Summary
     print("\n===== SUMMARY =====")
@@ -1,7 +1,18 @@
 # backend/app/fdc.py  # (rename from idc.py or update your import in main.py)
 import os
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from typing import Dict, Any, Optional, Tuple
+import httpx
 import requests
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # optional speedup
+    from json import loads as _json_loads
+from cachetools import TTLCache
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -9,18 +20,84 @@ from urllib3.util.retry import Retry
 FDC_BASE = os.getenv("FDC_BASE", "https://api.nal.usda.gov/fdc")
 FDC_TIMEOUT = float(os.getenv("FDC_TIMEOUT_S", "20"))
 FDC_RETRIES = int(os.getenv("FDC_RETRIES", "3"))
+FDC_POOL_SIZE = int(os.getenv("FDC_POOL_SIZE", "32"))
+
+# In-memory response caches shared by all clients (search results change
+# more often than food records, hence the shorter TTL)
+_search_cache = TTLCache(maxsize=1024, ttl=3600)
+_details_cache = TTLCache(maxsize=2048, ttl=86400)
+_cache_lock = threading.Lock()
+
+def _cache_get(cache: TTLCache, key):
+    with _cache_lock:
+        return cache.get(key)
+
+def _cache_put(cache: TTLCache, key, value) -> None:
+    with _cache_lock:
+        cache[key] = value
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_RETRY_METHODS = frozenset(["GET"])
+_RETRY_BACKOFF = 0.3
+
+# Shared async client for the event-loop paths (search_async/details_async).
+# The transport retries connect errors; status retries are in _request_async.
+_HTTPX = httpx.AsyncClient(
+    timeout=FDC_TIMEOUT,
+    transport=httpx.AsyncHTTPTransport(
+        retries=FDC_RETRIES,
+        http2=True,
+        limits=httpx.Limits(max_connections=64),
+    ),
+)
+
+def _retry_after_s(r: httpx.Response) -> Optional[float]:
+    """Seconds from a Retry-After header (delta or HTTP date), if present."""
+    value = r.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+async def _request_async(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Async counterpart of _make_session's Retry: only GETs are retried on
+    _RETRY_STATUSES (up to FDC_RETRIES times, 0.3 * 2**n backoff), and a
+    Retry-After header on 429/503 takes precedence over the backoff.
+    """
+    retries = FDC_RETRIES if method.upper() in _RETRY_METHODS else 0
+    for n in range(retries + 1):
+        r = await _HTTPX.request(method, url, **kwargs)
+        if r.status_code not in _RETRY_STATUSES or n == retries:
+            return r
+        delay = _retry_after_s(r) if r.status_code in (429, 503) else None
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** n if delay is None else delay)
+    return r
 
 def _make_session() -> requests.Session:
     s = requests.Session()
     retry = Retry(
         total=FDC_RETRIES,
-        backoff_factor=0.3,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=frozenset(["GET"]),
+        backoff_factor=_RETRY_BACKOFF,
+        status_forcelist=_RETRY_STATUSES,
+        allowed_methods=_RETRY_METHODS,
         raise_on_status=False,
     )
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
+    adapter = HTTPAdapter(
+        pool_connections=FDC_POOL_SIZE,
+        pool_maxsize=FDC_POOL_SIZE,
+        max_retries=retry,
+        pool_block=False,
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     return s
 
 class FDCClient:
@@ -32,21 +109,65 @@ class FDCClient:
         self.s = session or _make_session()
 
     def search(self, query: str, page_size: int = 10) -> Dict[str, Any]:
+        key = (query.lower(), page_size)
+        hit = _cache_get(_search_cache, key)
+        if hit is not None:
+            return hit
         params = {"api_key": self.api_key}
         payload = {"query": query, "pageSize": page_size}
         r = self.s.post(f"{FDC_BASE}/v1/foods/search", params=params, json=payload, timeout=FDC_TIMEOUT)
         r.raise_for_status()
-        return r.json()
+        out = _json_loads(r.content)
+        _cache_put(_search_cache, key, out)
+        return out
 
 
     def details(self, fdc_id: int) -> Dict[str, Any]:
+        hit = _cache_get(_details_cache, fdc_id)
+        if hit is not None:
+            return hit
         params = {"api_key": self.api_key}
         r = self.s.get(f"{FDC_BASE}/v1/food/{fdc_id}", params=params, timeout=FDC_TIMEOUT)
         r.raise_for_status()
-        return r.json()
+        out = _json_loads(r.content)
+        _cache_put(_details_cache, fdc_id, out)
+        return out
+
+    async def search_async(self, query: str, page_size: int = 10) -> Dict[str, Any]:
+        key = (query.lower(), page_size)
+        hit = _cache_get(_search_cache, key)
+        if hit is not None:
+            return hit
+        params = {"api_key": self.api_key}
+        payload = {"query": query, "pageSize": page_size}
+        r = await _request_async("POST", f"{FDC_BASE}/v1/foods/search", params=params, json=payload)
+        r.raise_for_status()
+        out = _json_loads(r.content)
+        _cache_put(_search_cache, key, out)
+        return out
+
+    async def details_async(self, fdc_id: int) -> Dict[str, Any]:
+        hit = _cache_get(_details_cache, fdc_id)
+        if hit is not None:
+            return hit
+        params = {"api_key": self.api_key}
+        r = await _request_async("GET", f"{FDC_BASE}/v1/food/{fdc_id}", params=params)
+        r.raise_for_status()
+        out = _json_loads(r.content)
+        _cache_put(_details_cache, fdc_id, out)
+        return out
+
+@lru_cache(maxsize=1)
+def get_default_client() -> FDCClient:
+    """Process-wide client so USDA calls reuse pooled keep-alive connections."""
+    return FDCClient()
+
+async def aclose_async_client() -> None:
+    """Close the shared httpx client (call on app shutdown)."""
+    await _HTTPX.aclose()
 
 # Common nutrient IDs
-ENERGY_NUTR_IDS = {1008, 2047}   # kcal, Energy (Atwater general)
+ENERGY_NUTR_IDS = (1008, 2047)   # kcal, Energy (Atwater general); in order of preference
 PROTEIN_ID = 1003
 FAT_ID = 1004
 CARB_ID = 1005
@@ -95,6 +216,17 @@ def extract_serving(food_json: Dict[str, Any]) -> Tuple[float, str]:
 
     return 100.0, "g"
 
+# Branded labelNutrients keys -> FDC nutrient IDs
+_LABEL_NUTRIENT_IDS = (
+    ("calories", 1008),
+    ("protein", PROTEIN_ID),
+    ("fat", FAT_ID),
+    ("carbohydrates", CARB_ID),
+    ("fiber", FIBER_ID),
+    ("sugars", SUGAR_ID),
+    ("sodium", SODIUM_ID),  # typically mg
+)
+
 def _collect_food_nutrients(food_json: Dict[str, Any]) -> Dict[int, float]:
     """
     Build a map of nutrient_id -> amount from both 'foodNutrients' and
@@ -104,42 +236,23 @@ def _collect_food_nutrients(food_json: Dict[str, Any]) -> Dict[int, float]:
       - foodNutrients already report amounts with IDs consistent with our expectations.
     """
     out: Dict[int, float] = {}
+    _int, _float = int, float
 
     # 1) Standard foodNutrients list
-    for n in food_json.get("foodNutrients", []) or []:
+    for n in food_json.get("foodNutrients") or ():
         nid = (n.get("nutrient") or {}).get("id") or n.get("nutrientId")
         amt = n.get("amount")
-        if nid is None or amt is None:
-            continue
-        try:
-            out[int(nid)] = float(amt)
-        except Exception:
-            pass
+        # Skip entries int()/float() would reject instead of catching per item
+        if nid is not None and str(nid).isdigit() and isinstance(amt, (int, float)):
+            out[_int(nid)] = _float(amt)
 
     # 2) Branded labelNutrients (per serving)
-    # Map common label keys to FDC nutrient IDs
+    # For sodium, label is usually mg already; others are grams/kcal as expected.
     ln = food_json.get("labelNutrients") or {}
-    label_map = {
-        "calories": 1008,
-        "protein": PROTEIN_ID,
-        "fat": FAT_ID,
-        "carbohydrates": CARB_ID,
-        "fiber": FIBER_ID,
-        "sugars": SUGAR_ID,
-        "sodium": SODIUM_ID,  # typically mg
-    }
-    for k, nid in label_map.items():
+    for k, nid in _LABEL_NUTRIENT_IDS:
         node = ln.get(k)
-        if not isinstance(node, dict):
-            continue
-        amt = node.get("value")
-        if amt is None:
-            continue
-        try:
-            # For sodium, label is usually mg already; others are grams/kcal as expected.
-            out.setdefault(nid, float(amt))
-        except Exception:
-            pass
+        if isinstance(node, dict) and isinstance(node.get("value"), (int, float)):
+            out.setdefault(nid, _float(node["value"]))
 
     return out
 
@@ -147,28 +260,32 @@ def nutrients_by_id(food_json: Dict[str, Any]) -> Dict[int, float]:
     """Public helper: nutrient_id -> amount."""
     return _collect_food_nutrients(food_json)
 
+# (output field, nutrient IDs in order of preference)
+_MACRO_FIELDS = (
+    ("calories_kcal", ENERGY_NUTR_IDS),
+    ("protein_g", (PROTEIN_ID,)),
+    ("fat_g", (FAT_ID,)),
+    ("carb_g", (CARB_ID,)),
+    ("fiber_g", (FIBER_ID,)),
+    ("sodium_mg", (SODIUM_ID,)),  # mg as expected by UI
+    ("sugars_g", (SUGAR_ID,)),
+)
+
 def summarize_macros(food_json: Dict[str, Any]) -> Dict[str, float]:
     """
     Return a compact macro dict expected by the UI/backend:
       - calories_kcal, protein_g, fat_g, carb_g, fiber_g, sodium_mg, sugars_g
     """
     ns = nutrients_by_id(food_json)
-
-    def get_any(ids, default=None):
-        for i in ids if isinstance(ids, (list, set, tuple)) else [ids]:
+    out: Dict[str, float] = {}
+    for name, ids in _MACRO_FIELDS:
+        v = 0.0
+        for i in ids:
             if i in ns:
-                return ns[i]
-        return default
-
-    return {
-        "calories_kcal": get_any(ENERGY_NUTR_IDS, 0.0),
-        "protein_g": get_any(PROTEIN_ID, 0.0),
-        "fat_g": get_any(FAT_ID, 0.0),
-        "carb_g": get_any(CARB_ID, 0.0),
-        "fiber_g": get_any(FIBER_ID, 0.0),
-        "sodium_mg": get_any(SODIUM_ID, 0.0),  # mg as expected by UI
-        "sugars_g": get_any(SUGAR_ID, 0.0),
-    }
+                v = ns[i]
+                break
+        out[name] = v
+    return out
 
 def tips_from_profile(profile: Dict[str, float]):
     tips = []
@@ -186,6 +303,8 @@ def tips_from_profile(profile: Dict[str, float]):
 
 __all__ = [
     "FDCClient",
+    "get_default_client",
+    "aclose_async_client",
     "pick_best_food",
     "extract_serving",
     "nutrients_by_id",
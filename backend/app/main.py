@@ -1,5 +1,5 @@
 # backend/app/main.py
-import os, io, time
+import os, io, time, asyncio
 from typing import Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
@@ -7,10 +7,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from PIL import Image
 
-from .rag import rag_query, build_query_from_nutrition
-from .vlm import classify, _clean_query  # helper for sanitizing labels
+from .rag import _ensure_index, embed_query, rag_query_with_embedding, build_query_from_nutrition
+from .vlm import classify_async, warmup_ollama, aclose_openai_async, aclose_batcher, _clean_query  # helper for sanitizing labels
 from .fdc import (
-    FDCClient,
+    get_default_client,
+    aclose_async_client,
     pick_best_food,
     extract_serving,
     summarize_macros,
@@ -28,6 +29,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+_WARMUP_TASKS = set()
+
+async def _warm_rag_index():
+    try:
+        await asyncio.to_thread(_ensure_index)
+    except Exception:
+        pass  # rag_query callers already degrade to no RAG tips
+
+@app.on_event("startup")
+async def _warmup():
+    # Load the embedding model/index and Ollama weights in the background so
+    # the first /api/analyze doesn't pay for them; requests can start meanwhile.
+    for coro in (_warm_rag_index(), warmup_ollama()):
+        task = asyncio.create_task(coro)
+        _WARMUP_TASKS.add(task)
+        task.add_done_callback(_WARMUP_TASKS.discard)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await aclose_async_client()
+    await aclose_openai_async()
+    await aclose_batcher()
+
+def _decode_image(buf: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(buf)).convert("RGB")
+
+async def _embed_rag_query(query: str):
+    """Embed a RAG query off the event loop; None if the RAG index is unavailable."""
+    try:
+        return await asyncio.to_thread(embed_query, query)
+    except Exception:
+        return None
+
 @app.get("/api/health")
 def health():
     return {"ok": True}
@@ -47,12 +81,14 @@ async def vlm_smoke(
     model: Optional[str] = Form(None),
 ):
     try:
-        img = Image.open(io.BytesIO(await image.read())).convert("RGB")
+        raw_bytes = await image.read()
+        # PIL decode is blocking; keep it off the event loop
+        img = await asyncio.to_thread(_decode_image, raw_bytes)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid image")
 
     try:
-        label, portion_g, conf, trace0 = classify(img, backend=backend, model=model)
+        label, portion_g, conf, trace0 = await classify_async(img, backend=backend, model=model)
         raw = trace0.get("raw")
         raw_text = (raw.get("message", {}) or {}).get("content") if isinstance(raw, dict) else None
         return {
@@ -71,7 +107,7 @@ async def vlm_smoke(
 @app.get("/api/usda_search")
 def usda_search(q: str):
     try:
-        client = FDCClient()
+        client = get_default_client()
         s = client.search(q, page_size=5)
         return s
     except Exception as e:
@@ -86,14 +122,16 @@ async def analyze(
 ):
     # --- Load image ---
     try:
-        img = Image.open(io.BytesIO(await image.read())).convert("RGB")
+        raw_bytes = await image.read()
+        # PIL decode is blocking; keep it off the event loop
+        img = await asyncio.to_thread(_decode_image, raw_bytes)
     except Exception:
         return JSONResponse({"error": "Invalid image"}, status_code=400)
 
     # --- Step 1: Vision-language inference ---
     try:
         t0 = time.time()
-        label, portion_g, conf, trace0 = classify(img, backend=backend, model=model)
+        label, portion_g, conf, trace0 = await classify_async(img, backend=backend, model=model)
         t_vlm = time.time() - t0
     except Exception as e:
         return JSONResponse({"error": f"VLM error: {e}"}, status_code=502)
@@ -101,23 +139,32 @@ async def analyze(
     # Clean up the label for USDA queries
     safe_query = _clean_query(label)
 
+    # Start embedding the RAG query now so it overlaps the USDA round-trips.
+    # The query uses only the label: build_query_from_nutrition reads
+    # calories/protein/fat/... keys, but summarize_macros returns
+    # calories_kcal/protein_g/..., so the scaled macros never reach it anyway.
+    rag_q = build_query_from_nutrition(label, {})
+    rag_emb_task = asyncio.create_task(_embed_rag_query(rag_q))
+
     # --- Step 2: USDA lookup ---
     client = None
     try:
-        client = FDCClient()
+        client = get_default_client()
         t1 = time.time()
-        search = client.search(safe_query, page_size=15)
+        search = await client.search_async(safe_query, page_size=15)
     except Exception:
         # retry with fallback query (first token)
         fallback = safe_query.split()[0] if safe_query.split() else safe_query
         try:
-            client = FDCClient()
-            search = client.search(fallback, page_size=10)
+            client = get_default_client()
+            search = await client.search_async(fallback, page_size=10)
         except Exception as e2:
+            rag_emb_task.cancel()
             return JSONResponse({"error": f"USDA lookup failed: {e2}"}, status_code=502)
 
     best = pick_best_food(search)
     if not best:
+        rag_emb_task.cancel()
         return {
             "label": label,
             "portion_g": portion_g,
@@ -131,27 +178,22 @@ async def analyze(
 
     try:
         fdc_id = int(best["fdcId"])
-        details = client.details(fdc_id)
+        details = await client.details_async(fdc_id)
         t_fdc = time.time() - t1
     except Exception as e:
+        rag_emb_task.cancel()
         return JSONResponse({"error": f"USDA details fetch failed: {e}"}, status_code=502)
 
     # --- Step 3: Nutrition + scaling ---
     serving_amt, serving_unit = extract_serving(details)
     profile = summarize_macros(details)
-    scaled = profile.copy()
-    if serving_unit and isinstance(serving_unit, str) and serving_unit.lower() == "g" and serving_amt:
-        try:
-            factor = float(portion_g) / float(serving_amt)
-        except Exception:
-            factor = 1.0
-        for k in scaled:
-            try:
-                scaled[k] = round((scaled[k] or 0.0) * factor, 2)
-            except Exception:
-                pass
+    if serving_unit and serving_unit.lower() == "g" and serving_amt:
+        # extract_serving/summarize_macros/_extract_from_text all return floats
+        factor = portion_g / serving_amt
+        scaled = {k: round(v * factor, 2) for k, v in profile.items()}
         serving_used = f"{portion_g:.0f} g (scaled from {serving_amt:.0f} g)"
     else:
+        scaled = profile
         serving_used = f"{serving_amt} {serving_unit} (unscaled)"
 
     # --- Step 4: Tips (heuristic + RAG) ---
@@ -160,8 +202,8 @@ async def analyze(
 
     # RAG-based guidance
     try:
-        rag_q = build_query_from_nutrition(label, scaled)
-        rag_results = rag_query(rag_q, top_k=3)
+        q_emb = await rag_emb_task
+        rag_results = rag_query_with_embedding(q_emb, top_k=3) if q_emb is not None else []
         rag_tips = [r["text"] for r in rag_results]
     except Exception:
         rag_results = []
@@ -1,15 +1,38 @@
 # backend/app/rag.py
 import os
 import glob
+import hashlib
 import json
+import tempfile
+import threading
 from typing import List, Tuple
 
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
+try:
+    import faiss  # optional: only used for large corpora
+except ImportError:
+    faiss = None
 
 _CORPUS = None        # type: List[Tuple[str, str]]
 _EMBEDDINGS = None    # type: np.ndarray
 _MODEL = None         # type: SentenceTransformer
+_FAISS_INDEX = None   # type: faiss.IndexFlatIP, built when the corpus is large
+
+_EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+_EMBED_BATCH_SIZE = 64
+_INDEX_LOCK = threading.Lock()
+_FAISS_MIN_DOCS = 10_000
+# Per-thread score buffer reused across queries (rag_query may run in worker threads)
+_SCORES_TLS = threading.local()
+
+# On-disk embedding cache, invalidated by a hash of model + corpus
+_INDEX_DIR = os.path.abspath(
+    os.getenv("RAG_INDEX_DIR", os.path.join(os.path.dirname(__file__), ".."))
+)
+_INDEX_PATH = os.path.join(_INDEX_DIR, "rag_index.npy")
+_INDEX_SHA_PATH = os.path.join(_INDEX_DIR, "rag_index.sha")
 
 
 def _load_corpus(doc_dir: str) -> List[Tuple[str, str]]:
@@ -31,54 +54,169 @@ def _load_corpus(doc_dir: str) -> List[Tuple[str, str]]:
     return docs
 
 
+def _corpus_hash(corpus: List[Tuple[str, str]]) -> str:
+    h = hashlib.sha256(_EMBED_MODEL_NAME.encode() + b"\0float32")
+    for fname, text in corpus:
+        h.update(b"\0" + fname.encode() + b"\0" + text.encode())
+    return h.hexdigest()
+
+
+def _load_cached_embeddings(sha: str):
+    """Memory-map the saved embeddings if they were built from this corpus."""
+    try:
+        with open(_INDEX_SHA_PATH, "r", encoding="utf-8") as f:
+            if f.read().strip() != sha:
+                return None
+        return np.load(_INDEX_PATH, mmap_mode="r")
+    except Exception:
+        return None
+
+
+def _atomic_write(path: str, write) -> None:
+    """
+    Write via a temp file in the same directory, then os.replace it in.
+    Other processes may have the old .npy memory-mapped; replacing the
+    directory entry leaves their mapping intact, rewriting in place doesn't.
+    """
+    fd, tmp = tempfile.mkstemp(dir=_INDEX_DIR, prefix=".rag_index.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _save_cached_embeddings(emb: np.ndarray, sha: str) -> None:
+    # Best effort: a read-only checkout just re-encodes on next start
+    try:
+        # Drop the old sha first so the new .npy is never paired with it
+        try:
+            os.remove(_INDEX_SHA_PATH)
+        except FileNotFoundError:
+            pass
+        _atomic_write(_INDEX_PATH, lambda f: np.save(f, emb))
+        _atomic_write(_INDEX_SHA_PATH, lambda f: f.write(sha.encode("utf-8")))
+    except Exception:
+        pass
+
+
 def _ensure_index():
     """
     Lazily load the corpus and build embeddings once
-    for the lifetime of the process.
+    for the lifetime of the process. Embeddings are reused
+    from disk when the corpus is unchanged.
     """
-    global _CORPUS, _EMBEDDINGS, _MODEL
+    global _CORPUS, _EMBEDDINGS, _MODEL, _FAISS_INDEX
     if _CORPUS is not None and _EMBEDDINGS is not None and _MODEL is not None:
         return
 
-    doc_dir = os.path.join(os.path.dirname(__file__), "..", "rag_docs")
-    doc_dir = os.path.abspath(doc_dir)
-
-    _CORPUS = _load_corpus(doc_dir)
-    if not _CORPUS:
-        _CORPUS = [("empty", "No nutrition guidance documents found.")]
-    # Small, fast embedding model
-    _MODEL = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-    texts = [text for _, text in _CORPUS]
-    _EMBEDDINGS = _MODEL.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    with _INDEX_LOCK:
+        if _CORPUS is not None and _EMBEDDINGS is not None and _MODEL is not None:
+            return
+
+        doc_dir = os.path.join(os.path.dirname(__file__), "..", "rag_docs")
+        doc_dir = os.path.abspath(doc_dir)
+
+        corpus = _load_corpus(doc_dir)
+        if not corpus:
+            corpus = [("empty", "No nutrition guidance documents found.")]
+        # Small, fast embedding model; FP16 on GPU when available
+        # (still needed at query time even when the corpus cache hits)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        _MODEL = SentenceTransformer(_EMBED_MODEL_NAME, device=device)
+        if device == "cuda":
+            _MODEL.half()
+
+        sha = _corpus_hash(corpus)
+        emb = _load_cached_embeddings(sha)
+        if emb is None or emb.shape[0] != len(corpus):
+            emb = _encode([text for _, text in corpus])
+            emb = np.ascontiguousarray(emb, dtype=np.float32)
+            _save_cached_embeddings(emb, sha)
+        # C-contiguous float32 so scoring goes straight to BLAS sgemv
+        emb = np.ascontiguousarray(emb, dtype=np.float32)
+
+        if faiss is not None and emb.shape[0] >= _FAISS_MIN_DOCS:
+            index = faiss.IndexFlatIP(emb.shape[1])
+            index.add(np.array(emb))
+            _FAISS_INDEX = index
+        _CORPUS, _EMBEDDINGS = corpus, emb
+
+
+def _encode(texts: List[str]) -> np.ndarray:
+    return _MODEL.encode(
+        texts,
+        batch_size=_EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
 
 
 def _cosine_sim(a: np.ndarray, b: np.ndarray) -> np.ndarray:
     # a: (d,), b: (n, d) with L2-normalized rows -> cosine = dot product
-    return b @ a
+    # Written into a reused per-thread buffer; valid until the next call.
+    buf = getattr(_SCORES_TLS, "buf", None)
+    if buf is None or buf.shape[0] != b.shape[0]:
+        buf = _SCORES_TLS.buf = np.empty(b.shape[0], dtype=np.float32)
+    return np.dot(b, a, out=buf)
 
 
-def rag_query(query: str, top_k: int = 3) -> List[dict]:
+def embed_query(query: str) -> np.ndarray:
     """
-    Retrieve top_k snippets relevant to the query.
+    Encode a query into the (normalized) embedding space of the corpus.
+    Split out from rag_query so callers can compute it ahead of time.
+    """
+    _ensure_index()
+    return _encode([query])[0].astype(_EMBEDDINGS.dtype)
+
+
+def rag_query_with_embedding(q_emb: np.ndarray, top_k: int = 3) -> List[dict]:
+    """
+    Retrieve top_k snippets for a query already encoded with embed_query.
     Returns list of {source, text, score}.
     """
     _ensure_index()
 
-    q_emb = _MODEL.encode([query], convert_to_numpy=True, normalize_embeddings=True)[0]
-    scores = _cosine_sim(q_emb, _EMBEDDINGS)
-    idx = np.argsort(-scores)[:top_k]
+    q_emb = np.ascontiguousarray(q_emb, dtype=np.float32)
+    k = min(top_k, _EMBEDDINGS.shape[0])
+    if k <= 0:
+        return []
+
+    if _FAISS_INDEX is not None:
+        dists, ids = _FAISS_INDEX.search(q_emb[None, :], k)
+        hits = zip(ids[0].tolist(), dists[0].tolist())
+    else:
+        scores = _cosine_sim(q_emb, _EMBEDDINGS)
+        # O(n) partial select, then sort only the k winners
+        part = np.argpartition(-scores, k - 1)[:k]
+        idx = part[np.argsort(-scores[part])]
+        hits = ((int(i), float(scores[i])) for i in idx)
 
     results: List[dict] = []
-    for i in idx:
+    for i, score in hits:
         fname, text = _CORPUS[i]
         results.append({
             "source": fname,
             "text": text,
-            "score": float(scores[i]),
+            "score": score,
         })
     return results
 
 
+def rag_query(query: str, top_k: int = 3) -> List[dict]:
+    """
+    Retrieve top_k snippets relevant to the query.
+    Returns list of {source, text, score}.
+    """
+    return rag_query_with_embedding(embed_query(query), top_k=top_k)
+
+
 def build_query_from_nutrition(label: str, nutrition: dict) -> str:
     """
     Build a natural-language query using dish name and macros
@@ -1,11 +1,20 @@
 # backend/app/vlm.py
-import os, base64, io, json, re
+import os, asyncio, base64, io, re
+from functools import lru_cache
 from typing import Optional
 from PIL import Image
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # optional speedup
+    from json import loads as _json_loads
 
 # Default model if the client doesn't pass one
 DEFAULT_OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3-vl:8b")
 
+_JSON_BLOCK_RE = re.compile(r"\{.*\}", re.S)
+_LABEL_KV_RE = re.compile(r'"label"\s*:\s*"([^"]+)"', re.I)
+_LABEL_FALLBACK_RE = re.compile(r'label\s*[:=]\s*["\']?([A-Za-z0-9][^"\',\n]+)', re.I)
+
 def _extract_from_text(text: str):
     """
     Pull out label, portion_grams, confidence from model output.
@@ -13,11 +22,17 @@ def _extract_from_text(text: str):
     """
     label, portion, conf = None, None, None
 
+    # Generation stops at "}" (Ollama drops the stop string) or hits the
+    # token cap; close an unterminated object so it still parses
+    start = text.rfind("{")
+    if start != -1 and "}" not in text[start:]:
+        text = text + "}"
+
     # Try to parse the first JSON-looking block
-    m = re.search(r"\{.*\}", text, flags=re.S)
+    m = _JSON_BLOCK_RE.search(text)
     if m:
         try:
-            j = json.loads(m.group(0))
+            j = _json_loads(m.group(0))
             label = j.get("label") or j.get("dish") or j.get("class")
             portion = j.get("portion_grams")
             conf = j.get("confidence")
@@ -26,11 +41,11 @@ def _extract_from_text(text: str):
 
     # Fallbacks for label
     if not label:
-        m = re.search(r'"label"\s*:\s*"([^"]+)"', text, flags=re.I)
+        m = _LABEL_KV_RE.search(text)
         if m:
             label = m.group(1)
     if not label:
-        m = re.search(r'label\s*[:=]\s*["\']?([A-Za-z0-9][^"\',\n]+)', text, flags=re.I)
+        m = _LABEL_FALLBACK_RE.search(text)
         if m:
             label = m.group(1).strip()
 
@@ -58,102 +73,110 @@ def _extract_from_text(text: str):
 
     return label or "unknown", portion, conf
 
+_CLEAN_RE1 = re.compile(r"\s+")
+_CLEAN_RE2 = re.compile(r"[^A-Za-z0-9 /()-]")
+
 def _clean_query(s: str) -> str:
     """Make a USDA-safe query: strip noise & limit length."""
     # Ensure s is a string (handle lists or other types)
     if isinstance(s, list):
         s = s[0] if s else ""
     s = str(s) if s is not None else ""
+    return _clean_query_cached(s)
+
+@lru_cache(maxsize=4096)
+def _clean_query_cached(s: str) -> str:
     s = s.replace("&", " and ").replace("\n", " ").strip()
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"[^A-Za-z0-9 /()-]", "", s)
+    s = _CLEAN_RE1.sub(" ", s)
+    s = _CLEAN_RE2.sub("", s)
     words = s.split()
     return " ".join(words[:6]) if words else s
 
 # --- Performance helpers ---
 def _image_to_b64_fast(image: Image.Image) -> str:
     """Downscale + JPEG encode to reduce tokens and speed up inference."""
-    img = image.copy()
-    img.thumbnail((1024, 1024))  # cap longest side
+    # Cap longest side at 1024 without copying the full-size buffer first
+    w, h = image.size
+    scale = min(1024 / w, 1024 / h, 1.0)
+    img = image if scale == 1.0 else image.resize(
+        (max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS
+    )
     buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=85, optimize=True)
+    # Single-pass encode (no optimize pass), 4:2:0 chroma subsampling
+    img.save(buf, format="JPEG", quality=80, subsampling=2, progressive=False)
     return base64.b64encode(buf.getvalue()).decode("utf-8")
 
+def _b64_to_data_url(image_b64: str) -> str:
+    return "data:image/jpeg;base64," + image_b64
+
 def _image_to_data_url(image: Image.Image) -> str:
     """For OpenAI path: data URL (JPEG)."""
-    img = image.copy()
-    img.thumbnail((1024, 1024))
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=85, optimize=True)
-    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("utf-8")
+    return _b64_to_data_url(_image_to_b64_fast(image))
 
 # --- Backends ---
-def infer_with_ollama(image: Image.Image, model: Optional[str] = None):
-    from ollama import Client
-    client = Client(host=os.getenv("OLLAMA_HOST", "http://localhost:11434"))
-
-    prompt = (
-        'Return STRICT JSON only with no extra text. '
-        'Schema: {"label": <string>, "portion_grams": <float>, "confidence": <0-1>}. '
-        'Prefer Food-101 style labels; if unsure, still pick one best label.'
-    )
+_OLLAMA_PROMPT = (
+    'Return STRICT JSON only with no extra text. '
+    'Schema: {"label": <string>, "portion_grams": <float>, "confidence": <0-1>}. '
+    'Prefer Food-101 style labels; if unsure, still pick one best label.'
+)
+_OPENAI_PROMPT = 'Return STRICT JSON: {"label": <dish>, "portion_grams": <float>, "confidence": <0-1>}'
 
-    b64 = _image_to_b64_fast(image)
+def _ollama_host() -> str:
+    return os.getenv("OLLAMA_HOST", "http://localhost:11434")
 
-    res = client.chat(
+def _ollama_chat_kwargs(image_b64: str, model: Optional[str] = None) -> dict:
+    """Request body shared by the sync and async Ollama paths."""
+    return dict(
         model=(model or DEFAULT_OLLAMA_MODEL),   # pass-through
         messages=[{
             "role": "user",
-            "content": prompt,
-            "images": [b64],
+            "content": _OLLAMA_PROMPT,
+            "images": [image_b64],
         }],
         options={
             "temperature": 0.2,
             "num_ctx": 512,                      # smaller context → less compute
             "num_thread": os.cpu_count() or 8,   # use available CPU threads
+            "num_predict": 64,                   # reply is one short JSON object
+            "stop": ["}"],
         },
         keep_alive="30m",  # keep weights in memory to avoid reloads
     )
 
+def _parse_ollama(res):
     text = (res["message"]["content"] or "").strip()
     label, portion, conf = _extract_from_text(text)
     return label, portion, conf, {"backend": "ollama", "raw": res, "raw_text": text}
 
-def infer_with_openai(image: Image.Image, model: str = "gpt-4o-mini"):
-    from openai import OpenAI
-    import os
-
+def _openai_api_key() -> str:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         # This will show up as a clear error if env isn't loaded
         raise RuntimeError("OPENAI_API_KEY is not set in this process")
+    return api_key
 
-    # Force official OpenAI endpoint, ignore OPENAI_BASE_URL env
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://api.openai.com/v1",
-    )
-
-    prompt = 'Return STRICT JSON: {"label": <dish>, "portion_grams": <float>, "confidence": <0-1>}'
-    res = client.chat.completions.create(
+def _openai_chat_kwargs(image_b64: str, model: str) -> dict:
+    return dict(
         model=model,
         messages=[{
             "role": "user",
             "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": _image_to_data_url(image)}},
+                {"type": "text", "text": _OPENAI_PROMPT},
+                {"type": "image_url", "image_url": {"url": _b64_to_data_url(image_b64)}},
             ],
         }],
         temperature=0.2,
+        max_tokens=64,
         response_format={"type": "json_object"},
     )
-    
+
+def _parse_openai(res):
     # Safely extract content
     text = ""
     if res and res.choices and len(res.choices) > 0:
         content = res.choices[0].message.content
         text = (content or "").strip()
-    
+
     # Use _extract_from_text for consistency with Ollama
     label, portion, conf = _extract_from_text(text)
     return (
@@ -163,8 +186,184 @@ def infer_with_openai(image: Image.Image, model: str = "gpt-4o-mini"):
         {"backend": "openai", "raw": res.model_dump() if res else {}},
     )
 
-def classify(image: Image.Image, backend: str = "ollama", model: Optional[str] = None):
+def infer_with_ollama(image: Image.Image, model: Optional[str] = None, image_b64: Optional[str] = None):
+    from ollama import Client
+    client = Client(host=_ollama_host())
+    b64 = image_b64 or _image_to_b64_fast(image)
+    res = client.chat(**_ollama_chat_kwargs(b64, model))
+    return _parse_ollama(res)
+
+def infer_with_openai(image: Image.Image, model: str = "gpt-4o-mini", image_b64: Optional[str] = None):
+    from openai import OpenAI
+
+    # Force official OpenAI endpoint, ignore OPENAI_BASE_URL env
+    client = OpenAI(
+        api_key=_openai_api_key(),
+        base_url="https://api.openai.com/v1",
+    )
+    b64 = image_b64 or _image_to_b64_fast(image)
+    res = client.chat.completions.create(**_openai_chat_kwargs(b64, model))
+    return _parse_openai(res)
+
+# --- Ollama micro-batching ---
+OLLAMA_BATCH_MAX = int(os.getenv("OLLAMA_BATCH_MAX", "4"))
+OLLAMA_BATCH_WAIT_S = float(os.getenv("OLLAMA_BATCH_WAIT_MS", "20")) / 1000.0
+
+class BatchingClient:
+    """
+    Coalesce concurrent Ollama chat requests: collect up to `max_batch` pending
+    requests (or whatever arrived within `max_wait_s`) and send them together,
+    so the server can batch them across its OLLAMA_NUM_PARALLEL slots.
+    Bound to the event loop it was first used on.
+    """
+    def __init__(self, host: str, max_batch: int = OLLAMA_BATCH_MAX, max_wait_s: float = OLLAMA_BATCH_WAIT_S):
+        from ollama import AsyncClient
+        self._client = AsyncClient(host=host)
+        self.max_batch = max(1, max_batch)
+        self.max_wait_s = max_wait_s
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.loop = asyncio.get_running_loop()
+
+    async def submit(self, **chat_kwargs):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        fut = self.loop.create_future()
+        await self._queue.put((chat_kwargs, fut))
+        return await fut
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.empty():
+                # Nothing else waiting: send now rather than idling for max_wait_s
+                self._spawn_dispatch(batch)
+                continue
+            deadline = self.loop.time() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn_dispatch(batch)
+
+    def _spawn_dispatch(self, batch):
+        # Dispatch without waiting so one slow batch doesn't hold up the next
+        task = asyncio.create_task(self._dispatch(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def aclose(self) -> None:
+        """Stop the collector task (requests already dispatched still complete)."""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+
+    async def _dispatch(self, batch):
+        results = await asyncio.gather(
+            *[self._client.chat(**kw) for kw, _ in batch],
+            return_exceptions=True,
+        )
+        for (_, fut), res in zip(batch, results):
+            if fut.done():  # caller went away
+                continue
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+_BATCHER: Optional[BatchingClient] = None
+
+def _get_batcher() -> BatchingClient:
+    global _BATCHER
+    if _BATCHER is None or _BATCHER.loop is not asyncio.get_running_loop():
+        _BATCHER = BatchingClient(host=_ollama_host())
+    return _BATCHER
+
+async def aclose_batcher() -> None:
+    """Stop the shared BatchingClient's worker if it belongs to the running loop."""
+    global _BATCHER
+    if _BATCHER is not None and _BATCHER.loop is asyncio.get_running_loop():
+        batcher, _BATCHER = _BATCHER, None
+        await batcher.aclose()
+
+async def infer_with_ollama_async(image: Image.Image, model: Optional[str] = None, image_b64: Optional[str] = None):
+    """Non-blocking variant; overlaps with other requests when OLLAMA_NUM_PARALLEL > 1."""
+    # resize + JPEG encode is CPU-bound
+    b64 = image_b64 or await asyncio.to_thread(_image_to_b64_fast, image)
+    res = await _get_batcher().submit(**_ollama_chat_kwargs(b64, model))
+    return _parse_ollama(res)
+
+async def warmup_ollama(model: Optional[str] = None) -> None:
+    """Load model weights into Ollama ahead of the first request (best effort)."""
+    try:
+        from ollama import AsyncClient
+        await AsyncClient(host=_ollama_host()).generate(
+            model=(model or DEFAULT_OLLAMA_MODEL),
+            prompt="warmup",
+            options={"num_predict": 1},
+            keep_alive="30m",
+        )
+    except Exception:
+        pass
+
+# One AsyncOpenAI (and its connection pool) per event loop, like _get_batcher
+_OPENAI_ASYNC = None  # type: Optional[tuple]  # (loop, AsyncOpenAI)
+
+def _get_openai_async():
+    global _OPENAI_ASYNC
+    loop = asyncio.get_running_loop()
+    if _OPENAI_ASYNC is None or _OPENAI_ASYNC[0] is not loop:
+        from openai import AsyncOpenAI
+        # Force official OpenAI endpoint, ignore OPENAI_BASE_URL env
+        client = AsyncOpenAI(
+            api_key=_openai_api_key(),
+            base_url="https://api.openai.com/v1",
+        )
+        _OPENAI_ASYNC = (loop, client)
+    return _OPENAI_ASYNC[1]
+
+async def aclose_openai_async() -> None:
+    """Close the shared AsyncOpenAI client if it belongs to the running loop."""
+    global _OPENAI_ASYNC
+    if _OPENAI_ASYNC is not None and _OPENAI_ASYNC[0] is asyncio.get_running_loop():
+        client = _OPENAI_ASYNC[1]
+        _OPENAI_ASYNC = None
+        await client.close()
+
+async def infer_with_openai_async(image: Image.Image, model: str = "gpt-4o-mini", image_b64: Optional[str] = None):
+    client = _get_openai_async()
+    b64 = image_b64 or await asyncio.to_thread(_image_to_b64_fast, image)
+    res = await client.chat.completions.create(**_openai_chat_kwargs(b64, model))
+    return _parse_openai(res)
+
+def classify(
+    image: Image.Image,
+    backend: str = "ollama",
+    model: Optional[str] = None,
+    image_b64: Optional[str] = None,
+):
+    """`image_b64` (from _image_to_b64_fast) skips re-encoding when one image goes to several models."""
+    backend = (backend or "ollama").lower()
+    if backend == "openai":
+        return infer_with_openai(image, model or "gpt-4o-mini", image_b64=image_b64)
+    return infer_with_ollama(image, model, image_b64=image_b64)  # falls back to DEFAULT_OLLAMA_MODEL
+
+async def classify_async(
+    image: Image.Image,
+    backend: str = "ollama",
+    model: Optional[str] = None,
+    image_b64: Optional[str] = None,
+):
     backend = (backend or "ollama").lower()
     if backend == "openai":
-        return infer_with_openai(image, model or "gpt-4o-mini")
-    return infer_with_ollama(image, model)  # falls back to DEFAULT_OLLAMA_MODEL
+        return await infer_with_openai_async(image, model or "gpt-4o-mini", image_b64=image_b64)
+    return await infer_with_ollama_async(image, model, image_b64=image_b64)